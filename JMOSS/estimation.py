@@ -11,20 +11,42 @@ Written by Juan Jurado, Clark McGehee
         Air Data System Calibration." Journal of Aircraft 56.2 (2019): 517-528.
 """
 
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from pandas import read_csv
 from os.path import splitext, basename
 from JMOSS.utilities import mach_from_qc_pa, iterate_pa_oat
-from numpy import rad2deg, sqrt, zeros, column_stack, cos, tan, arcsin, arctan, diag, ix_, argmax, argmin, array, \
-    hstack, linspace, ones
-from numpy.linalg import inv, eig
+from numpy import deg2rad, sqrt, zeros, column_stack, cos, sin, tan, arcsin, arctan, arctan2, ix_, argmax, argmin, \
+    array, hstack, linspace, ones, ascontiguousarray, maximum, eye, finfo
+from numpy.linalg import inv
+from scipy.linalg import cho_factor, cho_solve
 from scipy.optimize import least_squares
 from scipy.spatial.transform import rotation as r
 from scipy.stats import chi2
 
+# Sea level speed of sound [kts] over sqrt of sea level standard temperature [K], so that TAS = M * sqrt(OAT) * this
+KTS_PER_MACH_ROOT_KELVIN = 661.478827231622 / sqrt(288.15)
+
+# Parameters the estimator computes with. Only these are converted to float arrays when a test point is added; any
+# other mapped parameter (e.g. time) is kept with the dtype it was parsed with
+NUMERIC_PARAMETERS = ('north velocity', 'east velocity', 'down velocity', 'geometric height', 'total pressure',
+                      'static pressure', 'total temperature', 'ambient temperature', 'angle of attack',
+                      'angle of slideslip', 'roll angle', 'pitch angle', 'true heading')
+
+
+@lru_cache(maxsize=None)
+def chi2_critical_value(alpha: float):
+    # 1-DOF chi-square quantile for a (1-alpha)% interval; only a handful of alphas are ever used, so cache them
+    return chi2.ppf(1 - alpha, 1)
+
 
 class JmossEstimator:
-    def __init__(self, parameter_names: dict):
+    def __init__(self, parameter_names: dict, quiet: bool = False):
+        # Set quiet=True to suppress all console messages, e.g. for scripted batch runs
+        self.quiet = quiet
         self.flight_data = {}
+        self.test_point_summaries = {}
         self.spe_results = {}
         self.spe_model = None
         self.parameter_names = parameter_names
@@ -61,8 +83,18 @@ class JmossEstimator:
         point = self.flight_data.get(label, None)
         if point is not None:
             raise IndexError('Test point labeled %s has already been added.' % label)
-        dataframe = read_csv(filename)
-        self.flight_data[label] = dataframe
+        # Only parse the mapped DAS columns, then convert the numeric ones in one pass to a single (K, N) buffer whose
+        # contiguous rows are kept as the test point's arrays, keyed by JMOSS parameter name
+        das_names = set(self.parameter_names.values())
+        numeric_dtypes = {das_name: float for name, das_name in self.parameter_names.items()
+                          if name in NUMERIC_PARAMETERS}
+        dataframe = read_csv(filename, usecols=lambda column: column in das_names, dtype=numeric_dtypes)
+        mapped = [(name, das_name) for name, das_name in self.parameter_names.items() if das_name in dataframe]
+        numeric = [(name, das_name) for name, das_name in mapped if name in NUMERIC_PARAMETERS]
+        values = ascontiguousarray(dataframe[[das_name for _, das_name in numeric]].to_numpy(dtype=float).T)
+        point = {name: dataframe[das_name].to_numpy() for name, das_name in mapped if name not in NUMERIC_PARAMETERS}
+        point.update((name, values[index]) for index, (name, _) in enumerate(numeric))
+        self.flight_data[label] = point
         info = self.get_test_point_summary(label)
         self.print_console_message('new point', label)
         self.print_console_message('point info', info)
@@ -74,13 +106,20 @@ class JmossEstimator:
         return point
 
     def get_test_point_summary(self, label: str):
+        # Summaries only depend on the flight data, so compute them once per test point and reuse them
+        info = self.test_point_summaries.get(label, None)
+        if info is None:
+            info = self.test_point_summaries[label] = self.summarize_test_point(label)
+        return info
+
+    def summarize_test_point(self, label: str):
         total_pres = self.get_test_point_parameter(label, 'total pressure')
         static_pres = self.get_test_point_parameter(label, 'static pressure')
         mach = mach_from_qc_pa((total_pres - static_pres) / static_pres)
         alt = self.get_test_point_parameter(label, 'geometric height')
         alt_tol = (alt.max() - alt.min()) / 2
         roll = self.get_test_point_parameter(label, 'roll angle')
-        turning = abs(rad2deg(roll)) > 15
+        turning = abs(roll) > deg2rad(15)
         turn_mach = mach[turning].mean()
         info = {'Min. speed': '%0.2f M' % mach.min(), 'Max. speed': '%0.2f M' % mach.max(),
                 'Level turn': '%0.2f M' % turn_mach.mean(), 'Min. alt': '%0.2f Kft' % (alt.min() / 1000),
@@ -89,8 +128,10 @@ class JmossEstimator:
 
     def get_test_point_parameter(self, label: str, parameter_name: str):
         data = self.get_test_point(label)
-        das_name = self.parameter_names[parameter_name]
-        parameter = data[das_name].to_numpy()
+        parameter = data.get(parameter_name, None)
+        if parameter is None:
+            raise KeyError('Parameter %s (%s) is not in test point %s.'
+                           % (parameter_name, self.parameter_names.get(parameter_name), label))
         return parameter
 
     @staticmethod
@@ -131,16 +172,21 @@ class JmossEstimator:
         return messages
 
     def print_console_message(self, message_id: str, message_variables=None):
+        if self.quiet:
+            return
         message = self.messages[message_id]
         if message_variables is not None:
             if isinstance(message_variables, dict):
                 dict_variables = ['%s : %s' % (key, value) for key, value in message_variables.items()]
-                dict_strs = '\n'.join(dict_variables)
-                print(message % dict_strs, end='')
+                message = message % '\n'.join(dict_variables)
             else:
-                print(message % message_variables, end='')
-        else:
-            print(message, end='')
+                message = message % message_variables
+        # Messages are only written to the stream here; callers flush once a unit of work (e.g. a test point) is done
+        sys.stdout.write(message)
+
+    def flush_console(self):
+        if not self.quiet:
+            sys.stdout.flush()
 
     def get_results(self, labels: list = None):
         if labels is None:
@@ -153,68 +199,129 @@ class JmossEstimator:
             all_results.append(results)
         return all_results
 
-    def process_test_points(self, labels: list = None):
+    def process_test_points(self, labels: list = None, n_jobs: int = 1):
+        # Test points are independent, so with n_jobs > 1 (or None for all cores) they are solved in parallel processes
         if labels is None:
             labels = self.test_point_names_list
-        for label in labels:
-            self.__process_test_point(label)
+        if n_jobs == 1 or len(labels) < 2:
+            for label in labels:
+                self.__process_test_point(label)
+            return
+        problems = [self.__setup_test_point(label) for label in labels]
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = [executor.submit(self.solve_test_point, *problem) for problem in problems]
+            for label, future in zip(labels, futures):
+                self.print_console_message('processing', label)
+                self.spe_results[label] = future.result()
+                self.print_console_message('done')
+                self.flush_console()
 
     def __process_test_point(self, label):
+        # Print processing message
+        self.print_console_message('processing', label)
+
+        # Solve and record SPE results
+        self.spe_results[label] = self.solve_test_point(*self.__setup_test_point(label))
+
+        # Print done message
+        self.print_console_message('done')
+        self.flush_console()
+
+    def __setup_test_point(self, label):
         # Check for flight data
         if label not in self.test_point_names_list:
             raise IndexError('Test point %s not found.' % label)
 
-        # Print processing message
-        self.print_console_message('processing', label)
+        # Collect everything the solver needs as plain arrays so it can be shipped to a worker process
+        wind_x_axis = ascontiguousarray(self.get_frame_transform(label)[:, :, 0].T)
+        flight_data = self.extract_flight_data(label)
+        roll = self.get_test_point_parameter(label, 'roll angle')
+        turn_idx = abs(roll) > deg2rad(10)
+        return wind_x_axis, flight_data, turn_idx
 
+    @staticmethod
+    def solve_test_point(wind_x_axis, flight_data, turn_idx):
         # Use nonlinear least squares to solve for unknown variables
         params = zeros(5)
-        wind_to_nav = self.get_frame_transform(label)
-        flight_data = self.extract_flight_data(label)
-        lsq = least_squares(self.jmoss_obj_tat, params, args=[wind_to_nav, flight_data], method='lm')
-
-        # Use the lsq results to produce and record SPE results along wth auxiliary data for model fitting
-        roll = self.get_test_point_parameter(label, 'roll angle')
-        turn_idx = abs(rad2deg(roll)) > 10
-        results = self.SpeResults(flight_data, lsq, turn_idx)
-        self.spe_results[label] = results
+        last_solution = {}
+        lsq = least_squares(JmossEstimator.jmoss_obj_tat, params, jac=JmossEstimator.jmoss_jac_tat,
+                            args=[wind_x_axis, flight_data, last_solution], method='lm')
 
-        # Print done message
-        self.print_console_message('done')
+        # Use the lsq results to produce SPE results along wth auxiliary data for model fitting
+        return JmossEstimator.SpeResults(flight_data, lsq, turn_idx, last_solution)
 
     @staticmethod
-    def jmoss_obj_tat(params, wind_to_nav, flight_data):
+    def true_airspeed_tat(params, flight_data, last_solution=None):
         # Unload data
-        tot_pres = flight_data[:, 0]
-        tat = flight_data[:, 1]
-        gs_n_meas = flight_data[:, 2:5]
-        height = flight_data[:, 5]
+        tot_pres = flight_data['total pressure']
+        tat = flight_data['total temperature']
+        height = flight_data['geometric height']
 
         # Unload model parameters
         pa_bias = params[0]
-        wind = params[[1, 2, 3]]
         eta_model = params[4]
 
-        # Iterate to find ambient pressure, oat, and mach based on current parameter estimates
-        amb_pres, oat, mach_pc = iterate_pa_oat(height, tot_pres, tat, pa_bias, eta_model)
+        # Iterate to find ambient pressure, oat, and mach based on current parameter estimates, then true airspeed
+        # LM evaluates the residual and Jacobian at the same parameters, and SpeResults needs the converged solution
+        # again, so the most recent solve is remembered in last_solution when one is provided
+        if last_solution and last_solution['parameters'] == (pa_bias, eta_model):
+            amb_pres, oat, mach_pc = last_solution['solution']
+        else:
+            amb_pres, oat, mach_pc = iterate_pa_oat(height, tot_pres, tat, pa_bias, eta_model)
+            if last_solution is not None:
+                last_solution['parameters'] = (pa_bias, eta_model)
+                last_solution['solution'] = (amb_pres, oat, mach_pc)
+        tas_w = mach_pc * sqrt(oat) * KTS_PER_MACH_ROOT_KELVIN
+        return tas_w
+
+    @staticmethod
+    def jmoss_obj_tat(params, wind_x_axis, flight_data, last_solution=None):
+        # Unload data and wind parameters
+        gs_n_meas = flight_data['ground velocity']
+        wind = params[[1, 2, 3]]
 
         # Compute true airspeed then rotate from wind frame to nav frame to compare against GPS
-        tas_w = mach_pc * sqrt(oat / 288.1500) * 661.478827231622
-        tas_n = wind_to_nav.apply(column_stack([tas_w, 0 * tas_w, 0 * tas_w]))
-        gs_n_est = tas_n + wind
-        error = gs_n_est.flatten(order='F') - gs_n_meas.flatten(order='F')
-        return error
+        # True airspeed lies along the wind-frame x axis, so only that axis (expressed in nav frame) is needed
+        # Vectors are stored as (3, N) so the stacked north/east/down residual is a contiguous ravel, not a copy
+        tas_w = JmossEstimator.true_airspeed_tat(params, flight_data, last_solution)
+        tas_n = wind_x_axis * tas_w
+        gs_n_est = tas_n + wind[:, None]
+        error = gs_n_est - gs_n_meas
+        return error.ravel()
+
+    @staticmethod
+    def jmoss_jac_tat(params, wind_x_axis, flight_data, last_solution=None):
+        # The residual is linear in the winds, so their columns are exact; only Pa bias and eta are differenced,
+        # and only through true airspeed, which costs two airspeed solves instead of one residual per parameter
+        num_samples = wind_x_axis.shape[1]
+        jac = zeros((3 * num_samples, params.shape[0]))
+        for axis in range(3):
+            jac[axis * num_samples:(axis + 1) * num_samples, axis + 1] = 1
+
+        # Forward differences with MINPACK's default step, matching what the LM solver would use on its own
+        tas_w = JmossEstimator.true_airspeed_tat(params, flight_data, last_solution)
+        for index in [0, 4]:
+            step = sqrt(finfo(float).eps) * abs(params[index])
+            if step == 0:
+                step = sqrt(finfo(float).eps)
+            stepped = params.copy()
+            stepped[index] += step
+            d_tas_w = (JmossEstimator.true_airspeed_tat(stepped, flight_data) - tas_w) / step
+            jac[:, index] = (wind_x_axis * d_tas_w).ravel()
+        return jac
 
     def extract_flight_data(self, label):
-        tot_pres = self.get_test_point_parameter(label, 'total pressure')
-        tat = self.get_test_point_parameter(label, 'total temperature')
-        n_vel = (1 / 1.6878) * self.get_test_point_parameter(label, 'north velocity')
-        e_vel = (1 / 1.6878) * self.get_test_point_parameter(label, 'east velocity')
-        d_vel = (1 / 1.6878) * self.get_test_point_parameter(label, 'down velocity')
-        height = self.get_test_point_parameter(label, 'geometric height')
-        stat_pres = self.get_test_point_parameter(label, 'static pressure')
-        aoa = self.get_test_point_parameter(label, 'angle of attack')
-        data = column_stack([tot_pres, tat, n_vel, e_vel, d_vel, height, stat_pres, aoa])
+        # Keep each quantity in its own contiguous array so the residual reads them without strided column views,
+        # with the GPS velocity as a (3, N) north/east/down block
+        n_vel = self.get_test_point_parameter(label, 'north velocity')
+        e_vel = self.get_test_point_parameter(label, 'east velocity')
+        d_vel = self.get_test_point_parameter(label, 'down velocity')
+        data = {'total pressure': self.get_test_point_parameter(label, 'total pressure'),
+                'total temperature': self.get_test_point_parameter(label, 'total temperature'),
+                'ground velocity': (1 / 1.6878) * array([n_vel, e_vel, d_vel]),
+                'geometric height': self.get_test_point_parameter(label, 'geometric height'),
+                'static pressure': self.get_test_point_parameter(label, 'static pressure'),
+                'angle of attack': self.get_test_point_parameter(label, 'angle of attack')}
         return data
 
     def get_frame_transform(self, label):
@@ -234,33 +341,41 @@ class JmossEstimator:
         alpha_corr = pitch - gamma
         beta_corr = arctan(cos(alpha_corr) * tan(aos_ind))
 
-        # Compute wind-to-nav rotation matrices
-        body_to_nav = r.Rotation.from_euler('ZYX', column_stack([yaw, pitch, roll]))
-        wind_to_body = r.Rotation.from_euler('ZYX', column_stack([-beta_corr, alpha_corr, 0 * alpha_corr])).inv()
-        wind_to_nav = body_to_nav * wind_to_body
+        # Compute wind-to-body rotation matrices directly, Ry(-alpha) @ Rz(beta), the inverse of the body-to-wind
+        # ZYX rotation (-beta, alpha, 0), then compose with body-to-nav into wind-to-nav matrices, shape (N, 3, 3)
+        c_alpha, s_alpha = cos(alpha_corr), sin(alpha_corr)
+        c_beta, s_beta = cos(beta_corr), sin(beta_corr)
+        wind_to_body = array([[c_alpha * c_beta, -c_alpha * s_beta, -s_alpha],
+                              [s_beta, c_beta, 0 * alpha_corr],
+                              [s_alpha * c_beta, -s_alpha * s_beta, c_alpha]]).transpose(2, 0, 1)
+        body_to_nav = r.Rotation.from_euler('ZYX', column_stack([yaw, pitch, roll])).as_matrix()
+        wind_to_nav = body_to_nav @ wind_to_body
         return wind_to_nav
 
     # Subclass for computing and storing SPE estimates with uncertainty
     class SpeResults:
-        def __init__(self, flight_data, lsq_results, turn_idx):
+        def __init__(self, flight_data, lsq_results, turn_idx, last_solution=None):
             # Unload flight data
-            tot_pres = flight_data[:, 0]
-            tat = flight_data[:, 1]
-            height = flight_data[:, 5]
-            stat_pres = flight_data[:, 6]
-            aoa = flight_data[:, 7]
+            tot_pres = flight_data['total pressure']
+            tat = flight_data['total temperature']
+            height = flight_data['geometric height']
+            stat_pres = flight_data['static pressure']
+            aoa = flight_data['angle of attack']
 
             # Unload least squares results
             beta = lsq_results.x
             jac = lsq_results.jac
             sse = lsq_results.cost
             mse = sse / (jac.shape[0] - beta.shape[0])
-            beta_cov = mse * inv(jac.T @ jac)
+            beta_cov = mse * cho_solve(cho_factor(jac.T @ jac), eye(beta.shape[0]))
 
             # Compute results
             pa_bias = beta[0]
             eta_model = beta[4]
-            amb_pres, oat, mach_pc = iterate_pa_oat(height, tot_pres, tat, pa_bias, eta_model)
+            if last_solution and last_solution['parameters'] == (pa_bias, eta_model):
+                amb_pres, oat, mach_pc = last_solution['solution']
+            else:
+                amb_pres, oat, mach_pc = iterate_pa_oat(height, tot_pres, tat, pa_bias, eta_model)
             mach_ic = mach_from_qc_pa((tot_pres - stat_pres) / stat_pres)
             spe_ratio = (stat_pres - amb_pres) / stat_pres
 
@@ -284,42 +399,43 @@ class JmossEstimator:
         def generate_inferences(self):
             # Unload flight data
             flight_data = self.flight_data
-            tot_pres = flight_data[:, 0]
-            tat = flight_data[:, 1]
-            height = flight_data[:, 5]
-            stat_pres = flight_data[:, 6]
+            tot_pres = flight_data['total pressure']
+            tat = flight_data['total temperature']
+            height = flight_data['geometric height']
+            stat_pres = flight_data['static pressure']
 
             # For SPE and OAT, we need to consider the covariance matrix of Pa bias and Eta
-            # Generate unit circle in 2D using 4 corners
-            circle = array([[1, 0], [0, 1], [-1, 0], [0, -1]]).T
-
-            # Scale unit sphere using eigenvalues and eigenvectors
             param_id = [0, 4]
             dim = len(param_id)
             parameters = self.raw_stats['parameters']
             covariance = self.raw_stats['covariance']
             sub_p = parameters[param_id].reshape((dim, 1))
             sub_cov = covariance[ix_(param_id, param_id)]
-            w, v = eig(sub_cov)
-            scale = sqrt(diag(w))
-            ellipse = v @ scale @ circle + sub_p
-
-            # Now evaluate all four points to find the min/max of pa and oat
-            amb_press = []
-            oats = []
-            for point in ellipse.T:
-                amb_pres, oat, _ = iterate_pa_oat(height, tot_pres, tat, point[0], point[1])
-                amb_press.append(amb_pres.mean())
-                oats.append(oat.mean())
-            id_min_pa = argmin(amb_press)
-            id_max_pa = argmax(amb_press)
-            id_min_oat = argmin(oats)
-            id_max_oat = argmax(oats)
-
-            low_pa, _, _ = iterate_pa_oat(height, tot_pres, tat, ellipse[0, id_min_pa], ellipse[1, id_min_pa])
-            hi_pa, _, _ = iterate_pa_oat(height, tot_pres, tat, ellipse[0, id_max_pa], ellipse[1, id_max_pa])
-            _, low_oat, _ = iterate_pa_oat(height, tot_pres, tat, ellipse[0, id_min_oat], ellipse[1, id_min_oat])
-            _, hi_oat, _ = iterate_pa_oat(height, tot_pres, tat, ellipse[0, id_max_oat], ellipse[1, id_max_oat])
+
+            # Closed-form eigen-decomposition of the symmetric 2x2 covariance: principal axis angle and variances
+            var_a, cov_ab, var_b = sub_cov[0, 0], sub_cov[0, 1], sub_cov[1, 1]
+            mean_var = (var_a + var_b) / 2
+            radius = sqrt(((var_a - var_b) / 2) ** 2 + cov_ab ** 2)
+            angle = arctan2(2 * cov_ab, var_a - var_b) / 2
+            axis_1 = sqrt(mean_var + radius) * array([cos(angle), sin(angle)])
+            axis_2 = sqrt(max(mean_var - radius, 0)) * array([-sin(angle), cos(angle)])
+
+            # Scale unit circle (4 corners) along the principal axes
+            ellipse = column_stack([axis_1, axis_2, -axis_1, -axis_2]) + sub_p
+
+            # Now evaluate all four points in one batched solve to find the min/max of pa and oat
+            amb_press, oats, _ = iterate_pa_oat(height, tot_pres, tat, ellipse[0][:, None], ellipse[1][:, None])
+            mean_pas = amb_press.mean(axis=1)
+            mean_oats = oats.mean(axis=1)
+            id_min_pa = argmin(mean_pas)
+            id_max_pa = argmax(mean_pas)
+            id_min_oat = argmin(mean_oats)
+            id_max_oat = argmax(mean_oats)
+
+            low_pa = amb_press[id_min_pa]
+            hi_pa = amb_press[id_max_pa]
+            low_oat = oats[id_min_oat]
+            hi_oat = oats[id_max_oat]
 
             hi_spe = (stat_pres - low_pa) / stat_pres
             low_spe = (stat_pres - hi_pa) / stat_pres
@@ -355,20 +471,20 @@ class JmossEstimator:
             # If there are knots, append the regression matrix with the knot columns
             knots = self.stats['knots']
             if knots is not None:
-                mach_knots = mach_ic.reshape(-1, 1) - knots.reshape(-1, 1).T
-                mach_knots[mach_knots < 0] = 0
-                x_pred = hstack([x_pred, mach_knots ** 2])
+                knot_basis = maximum(mach_ic[:, None] - knots[None, :], 0)
+                knot_basis *= knot_basis
+                x_pred = hstack([x_pred, knot_basis])
             # Predict spe ratio
             spe_ratio = x_pred @ self.stats['betas']
-            # Compute the standard error at the prediction points
+            # Compute the standard error at the prediction points, forming only the diagonal of X K X^T
             mse = self.stats['mse']
             kernel = self.stats['kernel']
-            spe_std = sqrt(diag(mse * x_pred @ kernel @ x_pred.T))
+            spe_std = sqrt(mse * ((x_pred @ kernel) * x_pred).sum(axis=1))
             # If a significance level was provided, multiply the standard error to cover the (1-alpha)% interval
             if alpha is None:
                 chi2val = 1
             else:
-                chi2val = chi2.ppf(1 - alpha, 1)
+                chi2val = chi2_critical_value(alpha)
             ci = sqrt(chi2val) * spe_std
             return spe_ratio, ci
 
@@ -390,10 +506,9 @@ class JmossEstimator:
             sigmas.append(sigma)
         machs = hstack(machs)
         spes = hstack(spes)
-        sigmas = hstack(spes) ** 2
-        # Compute the weight matrix
+        sigmas = hstack(sigmas) ** 2
+        # Compute the inverse-variance weights
         w = 1 / sigmas
-        w_mat = diag(w)
         # Build the regression matrix
         x_mat = column_stack([ones(machs.shape), machs, machs ** 2])
         # If supersonic, use spline knots to characterize transonic shapes and append to the regression matrix
@@ -405,16 +520,18 @@ class JmossEstimator:
             else:
                 knots = array(knots)
 
-            mach_knots = machs.reshape(-1, 1) - knots.reshape(-1, 1).T
-            mach_knots[mach_knots < 0] = 0
-            x_mat = hstack([x_mat, mach_knots ** 2])
-        # Build the stats model
-        kernel = inv(x_mat.T @ w_mat @ x_mat)
-        betas = kernel @ x_mat.T @ w_mat @ spes
+            knot_basis = maximum(machs[:, None] - knots[None, :], 0)
+            knot_basis *= knot_basis
+            x_mat = hstack([x_mat, knot_basis])
+        # Build the stats model, applying the diagonal weights row-wise rather than as an N x N matrix
+        x_mat_w = x_mat * w[:, None]
+        kernel = inv(x_mat_w.T @ x_mat)
+        betas = kernel @ (x_mat_w.T @ spes)
         res = spes - x_mat @ betas
-        sse = (res ** 2).sum()
+        sse = (w * res ** 2).sum()
         mse = sse / (res.shape[0] - x_mat.shape[1])
         stats = dict(betas=betas, kernel=kernel, mse=mse, knots=knots)
         smooth_mach = linspace(machs.min(initial=None), machs.max(initial=None), 1000)
         self.spe_model = self.SpeModel(smooth_mach, stats)
         self.print_console_message('done')
+        self.flush_console()
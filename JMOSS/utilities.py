@@ -9,57 +9,68 @@ Written by Juan Jurado, Clark McGehee
 
         Erb, Russell E. "Pitot-Statics Textbook." US Air Force Test Pilot School, Edwards AFB, CA (2020).
 """
-from numpy import zeros, sqrt, exp, cumsum, hstack, diff, array, log
-from scipy import optimize
+from numpy import zeros, empty, broadcast_to, sqrt, exp, cumsum, multiply, diff, array, log, log1p, expm1, where
 
 
 def mach_from_qc_pa(qc_over_pa: array):
     # Mach number from qc/Pa pressure ratio
-    mach = zeros(qc_over_pa.shape[0])
+    mach = zeros(qc_over_pa.shape)
     high = qc_over_pa > 0.89293
-    mach[~high] = sqrt(5 * ((abs(qc_over_pa[~high]) + 1) ** (2 / 7) - 1))
-    for index, value in enumerate(high):
-        if value:
-            sol = optimize.fsolve(lambda m: m - 0.881284 * sqrt((qc_over_pa[index] + 1)
-                                                                * (1 - 1 / (7 * m ** 2)) ** 2.5), x0=array([1]))
-            mach[index] = sol
+    # Fractional powers are written as exp/log1p (and sqrt) forms, which are cheaper than pow and keep the small
+    # differences from 1 accurate
+    mach[~high] = sqrt(5 * expm1(2 / 7 * log1p(abs(qc_over_pa[~high]))))
+    mach[high] = rayleigh_pitot_mach(qc_over_pa[high])
+    return mach
+
+
+def rayleigh_pitot_mach(qc_over_p: array, coefficient: float = 0.881284):
+    # Supersonic Mach number from the Rayleigh pitot relation M = coefficient * sqrt(qc/P + 1) * (1 - 1 / (7 M^2))^1.25,
+    # solved for all samples at once with Newton's method. The warm start is a least squares fit of M to
+    # [1, log(1 + qc/P), sqrt(qc/P)] over 1 <= M <= 4 (within 0.0016 M), so a few steps reach machine precision
+    scale = coefficient * sqrt(qc_over_p + 1)
+    mach = 0.198873 - 0.10066 * log1p(qc_over_p) + 0.917354 * sqrt(qc_over_p)
+    delta_mach = 1
+    while delta_mach > 1e-12:
+        ratio = 1 - 1 / (7 * mach * mach)
+        ratio_quarter = sqrt(sqrt(ratio))
+        step = (mach - scale * ratio * ratio_quarter) / (1 - scale * ratio_quarter * 2.5 / (7 * mach * mach * mach))
+        mach -= step
+        delta_mach = abs(step).max(initial=0)
     return mach
 
 
 def qc_pa_from_mach(mach: array):
     # qc/Pa pressure ratio from Mach number
-    qc_pa = zeros(mach.shape[0])
+    qc_pa = zeros(mach.shape)
     high = mach > 1
-    qc_pa[~high] = ((1 + 0.2 * (mach[~high] ** 2)) ** (7 / 2)) - 1
-    qc_pa[high] = (166.921 * mach[high] ** 7) / ((7 * mach[high] ** 2 - 1) ** 2.5) - 1
+    qc_pa[~high] = expm1(3.5 * log1p(0.2 * mach[~high] ** 2))
+    base = 7 * mach[high] ** 2 - 1
+    qc_pa[high] = (166.921 * mach[high] ** 7) / (base * base * sqrt(base)) - 1
     return qc_pa
 
 
-def delta_from_press_alt(press_alt: array):
-    # Pressure ratio from pressure altitude [ft]
-    delta = zeros(press_alt.shape[0])
-    high = press_alt > 36089.24
-    delta[high] = 0.223360 * exp(-4.80637e-5 * (press_alt[high] - 36089.24))
-    delta[~high] = (1 - 6.87559e-6 * press_alt[~high]) ** 5.2559
-    return delta
+def delta_from_press_alt(press_alt: array, high: array = None):
+    # Pressure ratio from pressure altitude [ft]. Pass the tropopause mask (press_alt > 36089.24) as high to reuse it
+    if high is None:
+        high = press_alt > 36089.24
+    return where(high, 0.223360 * exp(-4.80637e-5 * (press_alt - 36089.24)),
+                 exp(5.2559 * log1p(-6.87559e-6 * press_alt)))
 
 
 def press_alt_from_delta(delta: array):
     # Pressure altitude [ft] from pressure ratio
-    press_alt = zeros(delta.shape[0])
+    press_alt = zeros(delta.shape)
     high = delta < 0.223359324957103
-    press_alt[~high] = 1.454420638810633e5 * (1 - (delta[~high]) ** (1 / 5.2559))
+    press_alt[~high] = -1.454420638810633e5 * expm1(log(delta[~high]) / 5.2559)
     press_alt[high] = -2.080572240589052e4 * log(delta[high] / 0.223359324957103) + 36089.24
     return press_alt
 
 
-def theta_from_press_alt(press_alt: array):
-    # Temperature ratio from press_alt [ft]
-    theta = zeros(press_alt.shape[0])
-    high = press_alt > 36089.24
-    theta[high] = 0.751865
-    theta[~high] = 1 - 6.87559e-6 * press_alt[~high]
-    return theta
+def theta_from_press_alt(press_alt: array, high: array = None):
+    # Temperature ratio from press_alt [ft]. Pass the tropopause mask (press_alt > 36089.24) as high to reuse it
+    if high is None:
+        high = press_alt > 36089.24
+    return where(high, 0.751865, 1 - 6.87559e-6 * press_alt)
 
 
 def airspeed_from_qc_pa_delta(qc_over_pa: array, delta: array):
@@ -74,52 +85,67 @@ def airspeed_from_qc_psl(qc_over_psl: array):
     c1 = 5.829507067779927e2
     c2 = 661.478827231622
     high = qc_over_psl > 0.89293
-    airspeed = zeros(qc_over_psl.shape[0])
-    airspeed[~high] = c2 * sqrt(5 * ((qc_over_psl[~high] + 1) ** (2 / 7) - 1))
-    for index, value in enumerate(high):
-        if value:
-            sol = optimize.newton(lambda v: v - c1 * sqrt((qc_over_psl[index] + 1)
-                                                          * (1 - (1 / (7 * (v / c2) ** 2))) ** 2.5), x0=c2)
-            airspeed[index] = sol
+    airspeed = zeros(qc_over_psl.shape)
+    airspeed[~high] = c2 * sqrt(5 * expm1(2 / 7 * log1p(qc_over_psl[~high])))
+    # Supersonic branch is the Rayleigh pitot relation in terms of V / c2
+    airspeed[high] = c2 * rayleigh_pitot_mach(qc_over_psl[high], c1 / c2)
     return airspeed
 
 
 def iterate_pa_oat(height: array, tot_pres: array, tat: array, pa_bias: array, eta: array):
+    # Solve for ambient pressure, OAT and Mach along the last axis. Passing pa_bias and eta as (K, 1) columns
+    # solves K parameter sets against the same (N,) flight arrays at once and returns (K, N) arrays
+    # The tropopause mask is shared by the pressure and temperature ratios and only changes with pres_alt
     pres_alt = height + pa_bias
-    amb_pres = 14.6960 * delta_from_press_alt(pres_alt)
+    high = pres_alt > 36089.24
+    amb_pres = 14.6960 * delta_from_press_alt(pres_alt, high)
     mach_pc = mach_from_qc_pa((tot_pres - amb_pres) / amb_pres)
     oat_from_tat = (tat / (1 + 0.2 * eta * mach_pc ** 2))
-    oat_from_atm = 288.15 * theta_from_press_alt(pres_alt)
-    bias = oat_from_tat.mean() - oat_from_atm.mean()
+    oat_from_atm = 288.15 * theta_from_press_alt(pres_alt, high)
+    bias = oat_from_tat.mean(axis=-1, keepdims=True) - oat_from_atm.mean(axis=-1, keepdims=True)
     oat = oat_from_atm + bias
 
+    # Loop invariants: hypsometric height steps and the integration start point, one per parameter set
+    height_steps = diff(height)
+    start = height[..., :1] + pa_bias
+
     delta_pres_alt = 1000
     delta_oat = 1000
     while (delta_pres_alt > 1e-3) or (delta_oat > 1e-3):
-        temp_std = 288.15 * theta_from_press_alt(pres_alt)
-        delta = temp_std / oat
-        new_press_alt = cumsum(hstack([height[0], delta[1:] * diff(height)])) + pa_bias
-        delta_pres_alt = sum((pres_alt - new_press_alt) ** 2)
+        # oat_from_atm is the standard temperature at the current pres_alt, i.e. the hypsometric temperature ratio's
+        # numerator, so it is reused rather than recomputed
+        delta = oat_from_atm[..., 1:] / oat[..., 1:]
+        # Integrate the hypsometric steps in place in a single output array, already offset by pa_bias
+        new_press_alt = empty(oat.shape)
+        new_press_alt[..., :1] = start
+        multiply(delta, height_steps, out=new_press_alt[..., 1:])
+        cumsum(new_press_alt, axis=-1, out=new_press_alt)
+        delta_pres_alt = abs(pres_alt - new_press_alt).max()
         pres_alt = new_press_alt
+        high = pres_alt > 36089.24
 
-        amb_pres = 14.6960 * delta_from_press_alt(pres_alt)
+        amb_pres = 14.6960 * delta_from_press_alt(pres_alt, high)
         mach_pc = mach_from_qc_pa((tot_pres - amb_pres) / amb_pres)
         oat_from_tat = (tat / (1 + 0.2 * eta * mach_pc ** 2))
-        oat_from_atm = 288.15 * theta_from_press_alt(pres_alt)
-        bias = oat_from_tat.mean() - oat_from_atm.mean()
+        oat_from_atm = 288.15 * theta_from_press_alt(pres_alt, high)
+        bias = oat_from_tat.mean(axis=-1, keepdims=True) - oat_from_atm.mean(axis=-1, keepdims=True)
         new_oat = oat_from_atm + bias
-        delta_oat = sum((oat - new_oat) ** 2)
+        delta_oat = abs(oat - new_oat).max()
         oat = new_oat
     return amb_pres, oat, mach_pc
 
 
 def translate_spe_to_errors(spe_ratio: array, mach_ic: array, target_alt_ic: float = None):
     # Translate an array of spe ratio and instrument corrected mach number to  dHpc, dVpc, dMpc at a specified target
-    # instrument corrected altitude
+    # instrument corrected altitude. target_alt_ic may also be an array of K altitudes, which adds a leading axis of
+    # length K to each returned array
     if target_alt_ic is None:
-        target_alt_ic = array([0])
+        target_alt_ic = 0
+    target_alt_ic = array(target_alt_ic, dtype=float)
+    if target_alt_ic.ndim:
+        target_alt_ic = target_alt_ic.reshape(target_alt_ic.shape + (1,) * spe_ratio.ndim)
     else:
-        target_alt_ic = array([target_alt_ic])
+        target_alt_ic = target_alt_ic.reshape(1)
     sea_level_pres = 14.6960
     delta_ic = delta_from_press_alt(target_alt_ic)
     stat_pres = sea_level_pres * delta_ic
@@ -134,4 +160,7 @@ def translate_spe_to_errors(spe_ratio: array, mach_ic: array, target_alt_ic: flo
     alt_corr = pres_alt - target_alt_ic
     asp_corr = cal_spd - ind_spd
     mach_corr = mach_pc - mach_ic
+    if mach_corr.shape != alt_corr.shape:
+        # The Mach correction does not depend on altitude, so repeat it across the altitude axis
+        mach_corr = broadcast_to(mach_corr, alt_corr.shape).copy()
     return alt_corr, asp_corr, mach_corr
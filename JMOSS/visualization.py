@@ -11,20 +11,48 @@ Written by Juan Jurado, Clark McGehee
 """
 from matplotlib import cm, rc
 from matplotlib import pyplot as plt
+from matplotlib.collections import LineCollection
 from matplotlib.ticker import FormatStrFormatter
+from numpy import arange, argmax, array, column_stack, concatenate, cumsum, linspace, split, zeros
 
 from JMOSS.utilities import translate_spe_to_errors
 
 
+def downsample_indices(x: array, y: array, max_points: int):
+    # Indices of at most max_points samples of the curve (x, y) chosen with the largest-triangle-three-buckets
+    # algorithm: keep both end points and, from each bucket of samples in between, the one forming the largest
+    # triangle with the previously kept sample and the average of the next bucket
+    num_samples = x.shape[0]
+    if num_samples <= max_points or max_points < 3:
+        return arange(num_samples)
+    edges = linspace(1, num_samples - 1, max_points - 1).astype(int)
+    indices = zeros(max_points, dtype=int)
+    indices[-1] = num_samples - 1
+    for bucket in range(max_points - 2):
+        start, stop = edges[bucket], edges[bucket + 1]
+        if bucket + 2 < edges.shape[0]:
+            next_x, next_y = x[stop:edges[bucket + 2]].mean(), y[stop:edges[bucket + 2]].mean()
+        else:
+            next_x, next_y = x[-1], y[-1]
+        last = indices[bucket]
+        area = abs((x[last] - next_x) * (y[start:stop] - y[last]) - (x[last] - x[start:stop]) * (next_y - y[last]))
+        indices[bucket + 1] = start + argmax(area)
+    return indices
+
+
 class JmossVisualizer:
     def __init__(self, estimator):
         self.estimator = estimator
         self.figures = {}
         self.axes = {}
+        self.error_curves = {}
         self.colors = cm.get_cmap('tab20').colors
         self.font_rc = {'family': 'serif', 'weight': 'normal', 'size': 12}
+        rc('font', **self.font_rc)
 
-    def plot_spe_results(self, labels=None, title=None):
+    def plot_spe_results(self, labels=None, title=None, ax=None, max_points: int = None):
+        # Pass ax to draw into an existing axes (e.g. from plot_all_results) instead of a new figure. Pass max_points to
+        # downsample each curve to at most that many vertices
         if labels is None:
             labels = self.estimator.results_names_list
             results = self.estimator.get_results()
@@ -32,17 +60,16 @@ class JmossVisualizer:
             results = self.estimator.get_results(labels)
         if title is None:
             title = 'Static Position Error Ratio Results'
-        rc('font', **self.font_rc)
-        fig, ax = plt.subplots(1, 1, figsize=(10, 8))  # noqa
-        colors = self.colors
-        for index, point in enumerate(results):
-            mach_ic = point.mach_ic
-            spe_ratio = point.spe_ratio
-            spe_std = point.sigmas['spe ratio']
-            ax.plot(mach_ic, spe_ratio, color=colors[index], linestyle='-', linewidth=2,
-                    label=labels[index] + '$\pm 1\sigma$')
-            ax.plot(mach_ic, spe_ratio + spe_std, color=colors[index], linestyle='--', linewidth=2)
-            ax.plot(mach_ic, spe_ratio - spe_std, color=colors[index], linestyle='--', linewidth=2)
+        if ax is None:
+            fig, ax = plt.subplots(1, 1, figsize=(10, 8), constrained_layout=True)  # noqa
+        else:
+            fig = ax.figure
+        spe_ratios = [point.spe_ratio for point in results]
+        spe_stds = [point.sigmas['spe ratio'] for point in results]
+        self.plot_curves_with_bounds(ax, [point.mach_ic for point in results], spe_ratios,
+                                     [spe_ratio + spe_std for spe_ratio, spe_std in zip(spe_ratios, spe_stds)],
+                                     [spe_ratio - spe_std for spe_ratio, spe_std in zip(spe_ratios, spe_stds)], labels,
+                                     max_points)
         ax.legend()
         ax.set_xlabel("Instrument corrected Mach number, $M_{ic}$")
         ax.set_ylabel("SPE ratio, $\Delta P_p / P_s$")
@@ -50,7 +77,9 @@ class JmossVisualizer:
         self.grid_on(ax, 3)
         self.figures['spe results'] = [fig, ax]
 
-    def plot_oat_results(self, labels=None, title=None):
+    def plot_oat_results(self, labels=None, title=None, ax=None, max_points: int = None):
+        # Pass ax to draw into an existing axes (e.g. from plot_all_results) instead of a new figure. Pass max_points to
+        # downsample each curve to at most that many vertices
         if labels is None:
             labels = self.estimator.results_names_list
             results = self.estimator.get_results()
@@ -58,16 +87,13 @@ class JmossVisualizer:
             results = self.estimator.get_results(labels)
         if title is None:
             title = 'Outside Air Temperature Results'
-        rc('font', **self.font_rc)
-        fig, ax = plt.subplots(1, 1, figsize=(10, 8))  # noqa
-        colors = self.colors
-        for index, point in enumerate(results):
-            mach_ic = point.mach_ic
-            sigma = point.sigmas['oat']
-            ax.plot(mach_ic, point.oat, color=colors[index], linestyle='-', linewidth=2,
-                    label=labels[index] + '$\pm 1\sigma$')
-            ax.plot(mach_ic, point.oat + sigma, color=colors[index], linestyle='--', linewidth=2)
-            ax.plot(mach_ic, point.oat - sigma, color=colors[index], linestyle='--', linewidth=2)
+        if ax is None:
+            fig, ax = plt.subplots(1, 1, figsize=(10, 8), constrained_layout=True)  # noqa
+        else:
+            fig = ax.figure
+        self.plot_curves_with_bounds(ax, [point.mach_ic for point in results], [point.oat for point in results],
+                                     [point.oat + point.sigmas['oat'] for point in results],
+                                     [point.oat - point.sigmas['oat'] for point in results], labels, max_points)
         ax.legend()
         ax.set_xlabel("Instrument corrected Mach number, $M_{ic}$")
         ax.set_ylabel("Ambient temperature, $T_a$ [K]")
@@ -75,8 +101,10 @@ class JmossVisualizer:
         self.grid_on(ax)
         self.figures['oat results'] = [fig, ax]
 
-    def plot_adc_errors(self, target_alt_ic: float = 0, labels=None, title=None):
-        # Visualize altitude, airspeed, and Mach number corrections at sea level indicated altitude
+    def plot_adc_errors(self, target_alt_ic: float = 0, labels=None, title=None, axs=None, max_points: int = None):
+        # Visualize altitude, airspeed, and Mach number corrections at sea level indicated altitude. Pass a list of
+        # three axes as axs to draw into existing axes instead of a new figure. Pass max_points to downsample each
+        # curve to at most that many vertices
         if labels is None:
             labels = self.estimator.results_names_list
             results = self.estimator.get_results()
@@ -84,25 +112,20 @@ class JmossVisualizer:
             results = self.estimator.get_results(labels)
         if title is None:
             title = 'Air Data Computer Errors'
-        rc('font', **self.font_rc)
-        fig, axs = plt.subplots(3, 1, figsize=(11, 8), sharex=False)  # noqa
-        colors = self.colors
+        if axs is None:
+            fig, axs = plt.subplots(3, 1, figsize=(11, 8), sharex=True, constrained_layout=True)  # noqa
+        else:
+            fig = axs[0].figure
         curve_labels = ['$\Delta H_{pc}$ [ft]', '$\Delta V_{pc}$ [kts]', '$\Delta M_{pc}$']
-        for index, point in enumerate(results):
-            mach_ic = point.mach_ic
-            spe_ratio = point.spe_ratio
-            spe_std = point.sigmas['spe ratio']
-            spe_curves = translate_spe_to_errors(spe_ratio, mach_ic, target_alt_ic)
-            ci_curves1 = translate_spe_to_errors(spe_ratio + spe_std, mach_ic, target_alt_ic)
-            ci_curves2 = translate_spe_to_errors(spe_ratio - spe_std, mach_ic, target_alt_ic)
-            for ax_num in range(3):
-                axs[ax_num].plot(mach_ic, spe_curves[ax_num], color=colors[index], linestyle='-',
-                                 linewidth=2, label=labels[index] + '$\pm 1\sigma$')
-                axs[ax_num].plot(mach_ic, ci_curves1[ax_num], color=colors[index], linestyle='--',
-                                 linewidth=2)
-                axs[ax_num].plot(mach_ic, ci_curves2[ax_num], color=colors[index], linestyle='--',
-                                 linewidth=2)
-                axs[ax_num].set_ylabel(curve_labels[ax_num])
+        all_curves = self.get_error_curves(labels, results, target_alt_ic)
+        mach_ics = [point.mach_ic for point in results]
+        for ax_num in range(3):
+            # Only the top axes carries the legend
+            self.plot_curves_with_bounds(axs[ax_num], mach_ics, [curves[0][ax_num] for curves in all_curves],
+                                         [curves[1][ax_num] for curves in all_curves],
+                                         [curves[2][ax_num] for curves in all_curves], labels if ax_num == 0 else None,
+                                         max_points)
+            axs[ax_num].set_ylabel(curve_labels[ax_num])
         axs[0].set_title('%s, Ind. Alt:  %0.0f ft PA' % (title, target_alt_ic), weight='bold')
         axs[0].legend()
         axs[2].set_xlabel("Instrument corrected Mach number, $M_{ic}$")
@@ -111,12 +134,66 @@ class JmossVisualizer:
         self.grid_on(axs[2], 2)
         self.figures['adc results'] = [fig, axs]
 
+    def plot_all_results(self, target_alt_ic: float = 0, labels=None, max_points: int = None):
+        # SPE, OAT and ADC error results side by side in a single figure. The panels are also registered under their
+        # individual figure labels, so the model overlays (standalone=False) draw into this figure
+        fig = plt.figure(figsize=(24, 8), constrained_layout=True)
+        grid = fig.add_gridspec(3, 3)
+        ax_spe = fig.add_subplot(grid[:, 0])
+        ax_oat = fig.add_subplot(grid[:, 1])
+        ax_adc = fig.add_subplot(grid[0, 2])
+        axs_adc = [ax_adc] + [fig.add_subplot(grid[row, 2], sharex=ax_adc) for row in (1, 2)]
+        self.figures['all results'] = [fig, [ax_spe, ax_oat, axs_adc]]
+        self.plot_spe_results(labels, ax=ax_spe, max_points=max_points)
+        self.plot_oat_results(labels, ax=ax_oat, max_points=max_points)
+        self.plot_adc_errors(target_alt_ic, labels, axs=axs_adc, max_points=max_points)
+
+    def plot_curves_with_bounds(self, ax, x_values: list, centers: list, uppers: list, lowers: list, labels=None,
+                                max_points: int = None):
+        # Draw each test point's curve (solid) and its +/- 1 sigma bounds (dashed) in its own color. All points share
+        # one LineCollection per line style, so the artist count does not grow with the number of points; empty lines
+        # carry the legend entries so later ax.legend() calls still pick them up
+        if max_points is not None:
+            # Bounds reuse the samples picked for their curve so they stay aligned with it
+            keep = [downsample_indices(x, center, max_points) for x, center in zip(x_values, centers)]
+            x_values, centers, uppers, lowers = [[values[index] for values, index in zip(curves, keep)]
+                                                 for curves in (x_values, centers, uppers, lowers)]
+        colors = self.colors[:len(centers)]
+        ax.add_collection(LineCollection([column_stack([x, y]) for x, y in zip(x_values, centers)],
+                                         colors=colors, linewidths=2, linestyles='-'))
+        ax.add_collection(LineCollection([column_stack([x, y]) for x, upper, lower in zip(x_values, uppers, lowers)
+                                          for y in (upper, lower)],
+                                         colors=[color for color in colors for _ in range(2)], linewidths=2,
+                                         linestyles='--'))
+        if labels is not None:
+            for color, label in zip(colors, labels):
+                ax.plot([], [], color=color, linestyle='-', linewidth=2, label=label + '$\pm 1\sigma$')
+        ax.autoscale_view()
+
+    def get_error_curves(self, labels: list, results: list, target_alt_ic: float):
+        # Translate each point's SPE ratio and +/- 1 sigma bounds to ADC errors. The curves are kept per test point and
+        # indicated altitude, and every point that is new (or has been reprocessed since) is translated in a single
+        # stacked call. Each point's curves are a (bound, error, sample) array: bounds are nominal, +1 and -1 sigma,
+        # errors are altitude, airspeed and Mach
+        keys = [(label, target_alt_ic) for label in labels]
+        stale = [index for index, (key, point) in enumerate(zip(keys, results))
+                 if self.error_curves.get(key, (None,))[0] is not point]
+        if stale:
+            mach_ic = concatenate([results[index].mach_ic for index in stale])
+            spe_ratio = concatenate([results[index].spe_ratio for index in stale])
+            spe_std = concatenate([results[index].sigmas['spe ratio'] for index in stale])
+            errors = array(translate_spe_to_errors(array([spe_ratio, spe_ratio + spe_std, spe_ratio - spe_std]),
+                                                   mach_ic, target_alt_ic)).transpose(1, 0, 2)
+            splits = cumsum([results[index].mach_ic.shape[0] for index in stale])[:-1]
+            for index, curves in zip(stale, split(errors, splits, axis=-1)):
+                self.error_curves[keys[index]] = (results[index], curves)
+        return [self.error_curves[key][1] for key in keys]
+
     def plot_spe_model(self, title=None, alpha=0.05, standalone=False):
         if title is None:
             title = 'Static Position Error Ratio Model'
-        rc('font', **self.font_rc)
         if standalone:
-            fig, ax = plt.subplots(1, 1, figsize=(10, 8))  # noqa
+            fig, ax = plt.subplots(1, 1, figsize=(10, 8), constrained_layout=True)  # noqa
         else:
             fig = self.figures['spe results'][0]
             ax = self.figures['spe results'][1]
@@ -139,18 +216,16 @@ class JmossVisualizer:
         # Visualize altitude, airspeed, and Mach number corrections at sea level indicated altitude
         if title is None:
             title = 'Air Data Computer Error Models'
-        rc('font', **self.font_rc)
         if standalone:
-            fig, axs = plt.subplots(3, 1, figsize=(11, 8), sharex=False) # noqa
+            fig, axs = plt.subplots(3, 1, figsize=(11, 8), sharex=True, constrained_layout=True)  # noqa
         else:
             fig = self.figures['adc results'][0]
             axs = self.figures['adc results'][1]
         curve_labels = ['$\Delta H_{pc}$ [ft]', '$\Delta V_{pc}$ [kts]', '$\Delta M_{pc}$']
         mach_ic = self.estimator.spe_model.mach_ic
         spe_ratio, spe_ci = self.estimator.spe_model.predict(alpha=alpha)
-        spe_curves = translate_spe_to_errors(spe_ratio, mach_ic, target_alt_ic)
-        ci_curves1 = translate_spe_to_errors(spe_ratio + spe_ci, mach_ic, target_alt_ic)
-        ci_curves2 = translate_spe_to_errors(spe_ratio - spe_ci, mach_ic, target_alt_ic)
+        spe_curves, ci_curves1, ci_curves2 = array(translate_spe_to_errors(
+            array([spe_ratio, spe_ratio + spe_ci, spe_ratio - spe_ci]), mach_ic, target_alt_ic)).transpose(1, 0, 2)
         for ax_num in range(3):
             axs[ax_num].plot(mach_ic, spe_curves[ax_num], color='r', linestyle='-', linewidth=2, label='model')
             axs[ax_num].plot(mach_ic, ci_curves1[ax_num], color='r', linestyle='--', linewidth=2,
@@ -171,33 +246,52 @@ class JmossVisualizer:
         if sig_figs is None:
             sig_figs = 1
         fmt = '%%.%df' % sig_figs
+        # Each axis gets its own formatter, since matplotlib binds a formatter to the axis it is set on
         ax.yaxis.set_major_formatter(FormatStrFormatter(fmt))
         ax.xaxis.set_major_formatter(FormatStrFormatter(fmt))
-        ax.grid(which='minor', alpha=0.3, linestyle=":")
-        ax.grid(which='major', alpha=0.3, linestyle=":")
+        ax.grid(which='both', alpha=0.3, linestyle=":")
         ax.minorticks_on()
 
-    def save_figures(self, labels=None):
+    def save_figures(self, labels=None, file_format: str = 'pdf', rasterized: bool = False):
+        # Figures are saved as <label>.<file_format>; use file_format='png' for quick raster output. For batch runs
+        # without a display, set MPLBACKEND=Agg so no GUI backend is ever started
+        # With rasterized=True, the data curves of vector formats are embedded as images at the figure dpi while axes,
+        # text and grids stay vector, which makes dense results much smaller
         if labels is None:
-            labels = list(self.figures.keys())
+            # Panels of a combined figure share its entry, so each figure is only saved once, under its first label
+            labels = []
+            for label, (fig, _) in self.figures.items():
+                if all(fig is not self.figures[saved][0] for saved in labels):
+                    labels.append(label)
         for label in labels:
             fig = self.figures[label][0]
-            fig.savefig(label + '.pdf', dpi=fig.dpi, edgecolor='w', format='pdf', transparent=True,
-                        pad_inches=0.1, bbox_inches='tight')
+            # Remember each curve's own setting, so the figures are left exactly as they were after saving
+            data_artists = [(artist, artist.get_rasterized())
+                            for ax in fig.axes for artist in list(ax.lines) + list(ax.collections)]
+            if rasterized:
+                for artist, _ in data_artists:
+                    artist.set_rasterized(True)
+            try:
+                # Figures are laid out with constrained_layout when created, so no tight bounding box pass is needed
+                fig.savefig(label + '.' + file_format, dpi=fig.dpi, edgecolor='w', format=file_format, transparent=True)
+            finally:
+                if rasterized:
+                    for artist, was_rasterized in data_artists:
+                        artist.set_rasterized(was_rasterized)
 
     def print_aux_variable_results(self, labels=None):
         if labels is None:
             labels = self.estimator.results_names_list
-        results = self.estimator.get_results()
+            results = self.estimator.get_results()
+        else:
+            results = self.estimator.get_results(labels)
         wind_labels = ['north wind', 'east wind', 'down wind']
-        print('\nAuxiliary variable results with 1-sigma values:')
-        for index, point in enumerate(results):
-            print(labels[index] + ':')
-            est = point.eta
-            ci = point.sigmas['eta']
-            print('eta: %0.3f \u00B1 %0.3f' % (est, ci))
-            for dim, label in enumerate(wind_labels):
-                est = point.wind[dim]
-                ci = point.sigmas[label]
-                print('%s: %0.3f \u00B1 %0.3f' % (label, est, ci))
-            print()
+        # Build the whole report and print it at once
+        lines = ['\nAuxiliary variable results with 1-sigma values:']
+        for label, point in zip(labels, results):
+            lines.append(label + ':')
+            lines.append('eta: %0.3f \u00B1 %0.3f' % (point.eta, point.sigmas['eta']))
+            for dim, wind_label in enumerate(wind_labels):
+                lines.append('%s: %0.3f \u00B1 %0.3f' % (wind_label, point.wind[dim], point.sigmas[wind_label]))
+            lines.append('')
+        print('\n'.join(lines))
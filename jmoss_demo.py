@@ -10,8 +10,7 @@ Written by Juan Jurado, Clark McGehee
         Jurado, Juan D., and Clark C. McGehee. "Complete Online Algorithm for
         Air Data System Calibration." Journal of Aircraft 56.2 (2019): 517-528.
 """
-from os import listdir
-from os.path import join
+from os import scandir
 
 from JMOSS.estimation import JmossEstimator
 from JMOSS.visualization import JmossVisualizer
@@ -37,7 +36,9 @@ if __name__ == '__main__':
 
     # Load test points into estimator
     data_dir = 'sample_data'
-    data_files = [join(data_dir, name) for name in listdir(data_dir) if 'CLASS' in name]
+    # Entries from scandir already carry their full path, sort them so points are always added in the same order
+    with scandir(data_dir) as entries:
+        data_files = sorted(entry.path for entry in entries if 'CLASS' in entry.name)
     for filename in data_files:
         estimator.add_test_point(filename)
 
@@ -73,12 +74,10 @@ if __name__ == '__main__':
     # Print auxiliary variable (wind and eta) results
     visualizer.print_aux_variable_results()
 
-    # To plot the results of all points, use 'plot_xxx_results()'
-    # To get the results of a list of test points, use 'plot_xxx_results(list)'
-    # Where xxx is spe, oat, or adc
-    visualizer.plot_spe_results()
-    visualizer.plot_oat_results()
-    visualizer.plot_adc_errors()
+    # To plot the SPE, OAT, and ADC results of all points in one figure, use 'plot_all_results()'
+    # To plot them for a list of test points, use 'plot_all_results(labels=list)'
+    # Alternatively, use 'plot_spe_results()', 'plot_oat_results()', and 'plot_adc_errors()' for separate figures
+    visualizer.plot_all_results()
 
     # Visualize the final model
     # Use alpha to specify the significance level of the confidence interval
@@ -95,5 +94,6 @@ if __name__ == '__main__':
     # Save figures
     # To save all, use save_figures()
     # To save some of them, use save_figures(labels) where "labels" is a list containing any combination of:
-    # 'spe results', 'oat results', 'adc results', 'spe model', or 'adc model'
+    # 'all results', 'spe results', 'oat results', 'adc results', 'spe model', or 'adc model'
+    # Figures are saved as PDF by default, use save_figures(file_format='png') for faster raster output
     # visualizer.save_figures()